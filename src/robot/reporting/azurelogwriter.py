@@ -13,18 +13,36 @@
 #  limitations under the License.
 
 import base64
-import datetime
+import gzip
 import hashlib
 import hmac
 import json
 import logging
-import sys
-
-import requests
+import queue
+import threading
+import time
 
+from robot.errors import DataError
 from robot.result import ResultVisitor
 
 
+def _get_json_encoder():
+    # orjson is optional and imported only when needed. Importing it takes
+    # longer than importing everything else this module needs.
+    try:
+        from orjson import dumps
+    except ImportError:
+        def dumps(data):
+            return json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return dumps
+
+
+def _starttime_to_isoformat(stime):
+    if not stime:
+        return None
+    return f'{stime[:4]}-{stime[4:6]}-{stime[6:8]}T{stime[9:22]}000'
+
+
 class AzureLogWriter:
 
     def __init__(self, execution_result):
@@ -33,72 +51,142 @@ class AzureLogWriter:
     def write(self, output, settings):
         logger = logging.getLogger(output)
         logger.setLevel(logging.INFO)
-        file_handler = logging.FileHandler(output, encoding='utf-8')
-        file_handler.setLevel(logging.INFO)
+        logger.propagate = False
+        self._remove_handlers(logger)
+        file_handler = BufferedFileHandler(output, encoding='utf-8')
 
         # create a logging format
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        formatter = CachedTimeFormatter('%(asctime)s - %(levelname)s - %(message)s')
         file_handler.setFormatter(formatter)
+        logger.addHandler(file_handler)
 
-        console_handler = logging.StreamHandler(sys.stdout)
-        console_handler.setFormatter(formatter)
+        try:
+            azure_publisher = self._get_publisher(logger, settings)
+            try:
+                writer = AzureLogWriterVisitor(logger, azure_publisher)
+                self._execution_result.visit(writer)
+            finally:
+                azure_publisher.close()
+        finally:
+            self._remove_handlers(logger)
 
-        # add the handlers to the logger
-        logger.addHandler(file_handler)
-        logger.addHandler(console_handler)
+    def _remove_handlers(self, logger):
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+            handler.close()
+
+    def _get_publisher(self, logger, settings):
+        log_type = settings.log_type
+        if not (settings.customer_id and settings.shared_key and log_type
+                and log_type.upper() != 'NONE'):
+            return NullAzureLogPublisher(log_type)
+        publisher = AzureLogPublisher(logger, settings.customer_id,
+                                      settings.shared_key, log_type)
+        return QueuedAzureLogPublisher(publisher)
+
+
+class BufferedFileHandler(logging.FileHandler):
+    """FileHandler that does not flush the file after every record.
+
+    Records are left to the file's write buffer and the file is flushed
+    only after errors and when the handler is closed.
+    """
+
+    def flush(self):
+        # Called by StreamHandler.emit after each record.
+        pass
+
+    def emit(self, record):
+        super().emit(record)
+        if record.levelno >= logging.ERROR:
+            self._flush()
+
+    def _flush(self):
+        if self.stream:
+            self.stream.flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+        super().close()
+
+
+class CachedTimeFormatter(logging.Formatter):
+    """Formatter that formats the time part of ``asctime`` once per second."""
 
-        azure_publisher = AzureLogPublisher(logger, settings.customer_id, settings.shared_key, settings.log_type)
-        writer = AzureLogWriterVisitor(logger, azure_publisher)
-        self._execution_result.visit(writer)
+    def __init__(self, fmt=None):
+        super().__init__(fmt)
+        self._cache = (None, None)
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        cached_second, formatted = self._cache
+        if second != cached_second:
+            formatted = time.strftime(self.default_time_format,
+                                      self.converter(second))
+            self._cache = (second, formatted)
+        return self.default_msec_format % (formatted, record.msecs)
 
 
 class AzureLogWriterVisitor(ResultVisitor):
+    # Suites are posted in batches that are flushed when either limit is hit
+    batch_size = 50
+    batch_bytes = 1024 * 1024
+    _message_prefixes = {'FAIL': 'AssertionError: ',
+                         'SKIP': ': SkipExecution: '}
+
     def __init__(self, log_writer, azure_publisher):
-        self._writer = log_writer
+        self._log = log_writer.info
+        self._to_json = _get_json_encoder()
         self.azure_publisher = azure_publisher
-        self.testcases = []
+        # Test cases of the current suite as items of a JSON array and
+        # the suite's long name serialized for their 'classname'
+        self._testcases = bytearray()
+        self._classname = None
+        self._suite_stack = []
+        self._pending = []
+        self._pending_bytes = 0
 
     def start_suite(self, suite):
-        pass
-
-    def _get_stats(self, statistics):
-        return (
-            statistics.total,
-            statistics.failed,
-            statistics.skipped
-        )
+        self._suite_stack.append((self._testcases, self._classname))
+        self._testcases = bytearray()
+        self._classname = self._to_json(suite.longname)
 
     def end_suite(self, suite):
-        tests, failures, skipped = self._get_stats(suite.statistics)
-        attrs = {"name": suite.name,
-                 "tests": tests,
-                 "failures": failures,
-                 "skipped": skipped,
-                 "time": self._time_as_seconds(suite.elapsedtime),
-                 "timestamp": self._starttime_to_isoformat(suite.starttime),
-                 "testcases": self.testcases}
-        self._writer.info('testsuite {}'.format(json.dumps(attrs)))
-        self.azure_publisher.post_data(json.dumps([attrs]), self.azure_publisher.log_type)
+        stats = suite.statistics
+        timestamp = _starttime_to_isoformat(suite.starttime)
+        data = (b'{"name":%b,"tests":%d,"failures":%d,"skipped":%d,"time":"%.3f",'
+                b'"timestamp":%b,"testcases":[%b]}') % (
+            self._to_json(suite.name), stats.total, stats.failed, stats.skipped,
+            suite.elapsedtime / 1000, self._to_json(timestamp), self._testcases)
+        self._testcases, self._classname = self._suite_stack.pop()
+        self._log(f"testsuite {data.decode('utf-8')}")
+        self._pending.append(data)
+        self._pending_bytes += len(data)
+        if (len(self._pending) >= self.batch_size
+                or self._pending_bytes >= self.batch_bytes):
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self.azure_publisher.post_data(b'[' + b','.join(self._pending) + b']',
+                                           self.azure_publisher.log_type)
+            self._pending = []
+            self._pending_bytes = 0
 
     def visit_test(self, test):
         message = test.message
-        if test.failed:
-            message = 'AssertionError: {}'.format(test.message)
-        elif test.skipped:
-            message = ': SkipExecution: {}'.format(test.message)
-
-        testcase = {
-            'classname': test.parent.longname,
-            'name': test.name,
-            'time': self._time_as_seconds(test.elapsedtime),
-            'message': message
-        }
-        self._writer.info(testcase)
-        self.testcases.append(testcase)
-
-    def _time_as_seconds(self, millis):
-        return '{:.3f}'.format(millis / 1000)
+        prefix = self._message_prefixes.get(test.status)
+        if prefix:
+            message = prefix + message
+        if self._testcases:
+            self._testcases += b','
+        self._testcases += b'{"classname":%b,"name":%b,"time":"%.3f","message":%b}' % (
+            self._classname, self._to_json(test.name),
+            test.elapsedtime / 1000, self._to_json(message))
 
+    # Keywords, statistics and errors are not needed. Overriding these
+    # visitors to do nothing stops the traversal from entering them at all.
     def visit_keyword(self, kw):
         pass
 
@@ -109,52 +197,141 @@ class AzureLogWriterVisitor(ResultVisitor):
         pass
 
     def end_result(self, result):
-        pass
-
-    def _starttime_to_isoformat(self, stime):
-        if not stime:
-            return None
-        return f'{stime[:4]}-{stime[4:6]}-{stime[6:8]}T{stime[9:22]}000'
+        self._flush()
 
 
 class AzureLogPublisher:
+    # Seconds to wait for connecting and for the response
+    timeout = 60
+    _cached_epoch = 0
+    _cached_rfc1123 = ''
+
     def __init__(self, logger, customer_id, shared_key, log_type):
+        # Imported here to keep 'requests' out of rebot startup and to make
+        # it needed only when actually posting to Azure
+        try:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util import Retry
+        except ImportError:
+            raise DataError("Writing to Azure Log Analytics requires "
+                            "'requests' module to be installed.")
         self.logger = logger
         self.customer_id = customer_id
         self.shared_key = shared_key
         # The log type is the name of the event that is being submitted
         self.log_type = log_type
+        self._decoded_key = base64.b64decode(shared_key)
+        self._auth_prefix = f'SharedKey {customer_id}:'
+        self._uri = (f'https://{customer_id}.ods.opinsights.azure.com'
+                     f'/api/logs?api-version=2016-04-01')
+        # Reuse the connection to avoid a TLS handshake per post and back off
+        # when Azure is throttling or temporarily unavailable. Read errors are
+        # not retried because the data may already have been ingested.
+        retries = Retry(total=5, read=0, backoff_factor=0.5,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=['POST'], raise_on_status=False)
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=4,
+                                                    max_retries=retries))
 
     # Build the API signature
     def build_signature(self, date, content_length, method, content_type, resource):
-        x_headers = 'x-ms-date:' + date
-        string_to_hash = "{}\n{}\n{}\n{}\n{}".format(method, content_length, content_type, x_headers, resource)
-        bytes_to_hash = bytes(string_to_hash, encoding="utf-8")
-        decoded_key = base64.b64decode(self.shared_key)
+        bytes_to_hash = b'%b\n%d\n%b\nx-ms-date:%b\n%b' % (
+            method.encode(), content_length, content_type.encode(), date.encode(),
+            resource.encode())
         encoded_hash = base64.b64encode(
-            hmac.new(decoded_key, bytes_to_hash, digestmod=hashlib.sha256).digest()).decode()
-        authorization = "SharedKey {}:{}".format(self.customer_id, encoded_hash)
-        return authorization
+            hmac.new(self._decoded_key, bytes_to_hash, digestmod=hashlib.sha256).digest()).decode()
+        return self._auth_prefix + encoded_hash
+
+    # The date has one second resolution so it only needs formatting
+    # when the second changes
+    @classmethod
+    def _rfc1123date(cls):
+        now = int(time.time())
+        if now != cls._cached_epoch:
+            cls._cached_rfc1123 = time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                                                time.gmtime(now))
+            cls._cached_epoch = now
+        return cls._cached_rfc1123
 
     # Build and send a request to the POST API
     def post_data(self, body, log_type):
         method = 'POST'
         content_type = 'application/json'
         resource = '/api/logs'
-        rfc1123date = datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
+        rfc1123date = self._rfc1123date()
+        # Fastest compression level is enough for the repetitive JSON
+        body = gzip.compress(body, compresslevel=1)
         content_length = len(body)
         signature = self.build_signature(rfc1123date, content_length, method, content_type, resource)
-        uri = "https://{}.ods.opinsights.azure.com{}?api-version=2016-04-01".format(self.customer_id, resource)
 
         headers = {
             'content-type': content_type,
+            'Content-Encoding': 'gzip',
             'Authorization': signature,
             'Log-Type': log_type,
             'x-ms-date': rfc1123date
         }
 
-        response = requests.post(uri, data=body, headers=headers)
+        response = self._session.post(self._uri, data=body, headers=headers,
+                                      timeout=self.timeout)
         if 200 <= response.status_code <= 299:
             self.logger.info('Accepted')
         else:
-            self.logger.error("Response code: {} {} {}".format(response.status_code, response.reason, response.text))
+            self.logger.error(f'Response code: {response.status_code} '
+                              f'{response.reason} {response.text}')
+
+    def close(self):
+        self._session.close()
+
+
+class NullAzureLogPublisher:
+    """Used when Azure Log Analytics is not configured. Posts nothing."""
+
+    def __init__(self, log_type=None):
+        self.log_type = log_type
+
+    def post_data(self, body, log_type):
+        pass
+
+    def close(self):
+        pass
+
+
+class QueuedAzureLogPublisher:
+    """Posts data with the wrapped publisher in a background thread.
+
+    Lets visiting the result continue while the previous post is in flight.
+    """
+    _stop = object()
+
+    def __init__(self, publisher):
+        self._publisher = publisher
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def log_type(self):
+        return self._publisher.log_type
+
+    def post_data(self, body, log_type):
+        self._queue.put((body, log_type))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._stop:
+                break
+            # A failed post must not stop the thread or later batches are lost
+            try:
+                self._publisher.post_data(*item)
+            except Exception as err:
+                self._publisher.logger.error(f'Posting data failed: {err}')
+
+    def close(self):
+        self._queue.put(self._stop)
+        self._thread.join()
+        self._publisher.close()
@@ -0,0 +1,356 @@
+import base64
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from robot.reporting.azurelogwriter import (AzureLogPublisher, AzureLogWriter,
+                                            AzureLogWriterVisitor,
+                                            BufferedFileHandler,
+                                            CachedTimeFormatter,
+                                            NullAzureLogPublisher,
+                                            QueuedAzureLogPublisher)
+from robot.result import Result, TestSuite
+from robot.utils.asserts import assert_equal, assert_raises, assert_true
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+requires_requests = unittest.skipIf(requests is None,
+                                    "'requests' module is not installed")
+
+
+class TestAzureLogWriter(unittest.TestCase):
+
+    def test_nothing_is_posted_without_configuration(self):
+        for customer_id, shared_key, log_type in [(None, None, None),
+                                                  ('id', None, 'RobotTest'),
+                                                  (None, 'a2V5', 'RobotTest'),
+                                                  ('id', 'a2V5', None),
+                                                  ('id', 'a2V5', 'NONE')]:
+            settings = StubSettings(customer_id, shared_key, log_type)
+            publisher = AzureLogWriter(None)._get_publisher(None, settings)
+            assert_true(isinstance(publisher, NullAzureLogPublisher))
+
+    def test_handlers_are_not_left_to_logger(self):
+        suite = TestSuite(name='Suite')
+        suite.tests.create(name='Test')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'azure.log')
+            for _ in range(2):
+                AzureLogWriter(Result(root_suite=suite)).write(
+                    path, StubSettings(None, None, None))
+            assert_equal(logging.getLogger(path).handlers, [])
+            with open(path, encoding='utf-8') as log:
+                assert_equal(log.read().count('testsuite'), 2)
+
+    @requires_requests
+    def test_publisher_is_not_started_if_log_file_cannot_be_opened(self):
+        threads = threading.active_count()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'nonexisting', 'azure.log')
+            assert_raises(OSError, AzureLogWriter(Result()).write,
+                          path, StubSettings('id', 'a2V5', 'RobotTest'))
+        assert_equal(threading.active_count(), threads)
+        assert_equal(logging.getLogger(path).handlers, [])
+
+    @requires_requests
+    def test_publisher_is_closed_if_visiting_fails(self):
+        threads = threading.active_count()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'azure.log')
+            assert_raises(AttributeError, AzureLogWriter(None).write,
+                          path, StubSettings('id', 'a2V5', 'RobotTest'))
+        assert_equal(threading.active_count(), threads)
+        assert_equal(logging.getLogger(path).handlers, [])
+
+    @requires_requests
+    def test_queued_publisher_with_configuration(self):
+        settings = StubSettings('id', 'a2V5', 'RobotTest')
+        publisher = AzureLogWriter(None)._get_publisher(None, settings)
+        assert_true(isinstance(publisher, QueuedAzureLogPublisher))
+        assert_equal(publisher.log_type, 'RobotTest')
+        publisher.close()
+
+
+class TestBufferedFileHandler(unittest.TestCase):
+
+    def test_flushes_only_on_errors_and_close(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            handler = BufferedFileHandler(os.path.join(tmp, 'azure.log'),
+                                          encoding='utf-8')
+            handler.stream = stream = FlushCountingStream(handler.stream)
+            for index in range(250):
+                handler.handle(logging.makeLogRecord({'msg': index,
+                                                      'levelno': logging.INFO}))
+            assert_equal(stream.flushes, 0)
+            handler.handle(logging.makeLogRecord({'msg': 'error',
+                                                  'levelno': logging.ERROR}))
+            assert_equal(stream.flushes, 1)
+            handler.close()
+            assert_equal(stream.flushes, 2)
+            with open(handler.baseFilename, encoding='utf-8') as log:
+                assert_equal(log.read().splitlines(),
+                             [str(index) for index in range(250)] + ['error'])
+
+
+class TestCachedTimeFormatter(unittest.TestCase):
+
+    def test_format_matches_standard_formatter(self):
+        fmt = '%(asctime)s - %(levelname)s - %(message)s'
+        cached = CachedTimeFormatter(fmt)
+        standard = logging.Formatter(fmt)
+        for created in (1672628645.0, 1672628645.5, 1672628645.999, 1672628646.1):
+            record = logging.makeLogRecord({'msg': 'message', 'levelname': 'INFO',
+                                            'created': created,
+                                            'msecs': (created % 1) * 1000})
+            assert_equal(cached.format(record), standard.format(record))
+
+
+class TestAzureLogWriterVisitor(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = StubPublisher()
+        self.visitor = AzureLogWriterVisitor(logging.getLogger('utest.azure'),
+                                             self.publisher)
+
+    def test_testcases(self):
+        suite = TestSuite(name='Suite', starttime='20230102 03:04:05.678')
+        suite.tests.create(name='Passing', status='PASS', message='ok',
+                           starttime='20230102 03:04:05.678',
+                           endtime='20230102 03:04:06.789')
+        suite.tests.create(name='Failing', status='FAIL', message='bad')
+        suite.tests.create(name='Skipped', status='SKIP', message='later')
+        Result(root_suite=suite).visit(self.visitor)
+        data = self.publisher.posted()
+        assert_equal(len(data), 1)
+        assert_equal(data[0]['name'], 'Suite')
+        assert_equal(data[0]['tests'], 3)
+        assert_equal(data[0]['failures'], 1)
+        assert_equal(data[0]['skipped'], 1)
+        assert_equal(data[0]['timestamp'], '2023-01-02T03:04:05.678000')
+        assert_equal(data[0]['testcases'],
+                     [{'classname': 'Suite', 'name': 'Passing',
+                       'time': '1.111', 'message': 'ok'},
+                      {'classname': 'Suite', 'name': 'Failing',
+                       'time': '0.000', 'message': 'AssertionError: bad'},
+                      {'classname': 'Suite', 'name': 'Skipped',
+                       'time': '0.000', 'message': ': SkipExecution: later'}])
+
+    def test_special_characters_are_escaped(self):
+        suite = TestSuite(name='"Quoted" \\ Suite')
+        suite.tests.create(name='Hyvä\ntesti', status='FAIL', message='"}]')
+        Result(root_suite=suite).visit(self.visitor)
+        testcase = self.publisher.posted()[0]['testcases'][0]
+        assert_equal(testcase['classname'], '"Quoted" \\ Suite')
+        assert_equal(testcase['name'], 'Hyvä\ntesti')
+        assert_equal(testcase['message'], 'AssertionError: "}]')
+
+    def test_suite_contains_only_its_own_testcases(self):
+        root = TestSuite(name='Root')
+        root.tests.create(name='Root test')
+        for index in range(2):
+            sub = root.suites.create(name=f'Sub {index}')
+            sub.tests.create(name=f'Test {index}')
+        Result(root_suite=root).visit(self.visitor)
+        assert_equal([(suite['name'], [(test['classname'], test['name'])
+                                       for test in suite['testcases']])
+                      for suite in self.publisher.posted()],
+                     [('Sub 0', [('Root.Sub 0', 'Test 0')]),
+                      ('Sub 1', [('Root.Sub 1', 'Test 1')]),
+                      ('Root', [('Root', 'Root test')])])
+
+    def test_suites_are_posted_in_batches(self):
+        root = TestSuite(name='Root')
+        for index in range(5):
+            root.suites.create(name=f'Sub {index}')
+        self.visitor.batch_size = 2
+        Result(root_suite=root).visit(self.visitor)
+        assert_equal([len(json.loads(body)) for body in self.publisher.bodies],
+                     [2, 2, 2])
+        assert_equal([suite['name'] for suite in self.publisher.posted()],
+                     [f'Sub {index}' for index in range(5)] + ['Root'])
+
+    def test_batch_is_flushed_when_size_limit_is_exceeded(self):
+        root = TestSuite(name='Root')
+        root.suites.create(name='Sub')
+        self.visitor.batch_bytes = 1
+        Result(root_suite=root).visit(self.visitor)
+        assert_equal([len(json.loads(body)) for body in self.publisher.bodies],
+                     [1, 1])
+
+
+class TestAzureLogPublisher(unittest.TestCase):
+
+    @requires_requests
+    def test_build_signature(self):
+        key = base64.b64encode(b'secret').decode()
+        publisher = AzureLogPublisher(None, 'workspace', key, 'RobotTest')
+        date = 'Mon, 02 Jan 2023 03:04:05 GMT'
+        expected = base64.b64encode(hmac.new(
+            b'secret',
+            b'POST\n42\napplication/json\nx-ms-date:' + date.encode() + b'\n/api/logs',
+            hashlib.sha256
+        ).digest()).decode()
+        assert_equal(publisher.build_signature(date, 42, 'POST', 'application/json',
+                                               '/api/logs'),
+                     'SharedKey workspace:' + expected)
+        publisher.close()
+
+    @requires_requests
+    def test_post_data_is_compressed_and_signed(self):
+        key = base64.b64encode(b'secret').decode()
+        publisher = AzureLogPublisher(logging.getLogger('utest.azure'),
+                                      'workspace', key, 'RobotTest')
+        retries = publisher._session.get_adapter(publisher._uri).max_retries
+        assert_equal(retries.read, 0)
+        publisher._session.close()
+        publisher._session = session = StubSession()
+        publisher.post_data(b'[{"name":"Suite"}]', 'RobotTest')
+        uri, body, headers, timeout = session.posted
+        assert_equal(timeout, publisher.timeout)
+        assert_equal(uri, 'https://workspace.ods.opinsights.azure.com'
+                          '/api/logs?api-version=2016-04-01')
+        assert_equal(gzip.decompress(body), b'[{"name":"Suite"}]')
+        assert_equal(headers['Content-Encoding'], 'gzip')
+        assert_equal(headers['Log-Type'], 'RobotTest')
+        assert_equal(headers['Authorization'],
+                     publisher.build_signature(headers['x-ms-date'], len(body),
+                                               'POST', 'application/json',
+                                               '/api/logs'))
+
+    def test_rfc1123date_is_formatted_once_per_second(self):
+        now = [1672628645.1]
+        formatted = []
+
+        def strftime(format, struct):
+            formatted.append(struct)
+            return orig_strftime(format, struct)
+
+        orig_time, orig_strftime = time.time, time.strftime
+        orig_cache = (AzureLogPublisher._cached_epoch,
+                      AzureLogPublisher._cached_rfc1123)
+        time.time, time.strftime = lambda: now[0], strftime
+        try:
+            date = AzureLogPublisher._rfc1123date()
+            assert_equal(date, 'Mon, 02 Jan 2023 03:04:05 GMT')
+            now[0] = 1672628645.9
+            assert_true(AzureLogPublisher._rfc1123date() is date)
+            assert_equal(len(formatted), 1)
+            now[0] = 1672628646.0
+            assert_equal(AzureLogPublisher._rfc1123date(),
+                         'Mon, 02 Jan 2023 03:04:06 GMT')
+            assert_equal(len(formatted), 2)
+        finally:
+            time.time, time.strftime = orig_time, orig_strftime
+            (AzureLogPublisher._cached_epoch,
+             AzureLogPublisher._cached_rfc1123) = orig_cache
+
+
+class TestQueuedAzureLogPublisher(unittest.TestCase):
+
+    def test_posts_in_order_and_closes(self):
+        publisher = StubPublisher()
+        queued = QueuedAzureLogPublisher(publisher)
+        assert_equal(queued.log_type, 'RobotTest')
+        for index in range(10):
+            queued.post_data(json.dumps([{'index': index}]), 'RobotTest')
+        queued.close()
+        assert_equal(publisher.posted(), [{'index': i} for i in range(10)])
+        assert_true(publisher.closed)
+
+    def test_failing_post_is_logged_and_later_posts_continue(self):
+        publisher = FailingStubPublisher()
+        queued = QueuedAzureLogPublisher(publisher)
+        for index in range(3):
+            queued.post_data(json.dumps([{'index': index}]), 'RobotTest')
+        queued.close()
+        assert_equal(publisher.posted(), [{'index': 1}, {'index': 2}])
+        assert_equal(publisher.logger.errors, ['Posting data failed: Oh no!'])
+
+
+class StubPublisher:
+    log_type = 'RobotTest'
+
+    def __init__(self):
+        self.bodies = []
+        self.closed = False
+
+    def post_data(self, body, log_type):
+        assert_equal(log_type, self.log_type)
+        self.bodies.append(body)
+
+    def close(self):
+        self.closed = True
+
+    def posted(self):
+        return [item for body in self.bodies for item in json.loads(body)]
+
+
+class FlushCountingStream:
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.flushes = 0
+
+    def write(self, data):
+        self._stream.write(data)
+
+    def flush(self):
+        self.flushes += 1
+        self._stream.flush()
+
+    def close(self):
+        self._stream.close()
+
+
+class StubSession:
+    status_code = 200
+
+    def post(self, uri, data, headers, timeout):
+        self.posted = (uri, data, headers, timeout)
+        return self
+
+
+class FailingStubPublisher(StubPublisher):
+    """Fails the first post."""
+
+    def __init__(self):
+        super().__init__()
+        self.logger = StubLogger()
+        self._failed = False
+
+    def post_data(self, body, log_type):
+        if not self._failed:
+            self._failed = True
+            raise ValueError('Oh no!')
+        super().post_data(body, log_type)
+
+
+class StubLogger:
+
+    def __init__(self):
+        self.errors = []
+
+    def error(self, message):
+        self.errors.append(message)
+
+
+class StubSettings:
+
+    def __init__(self, customer_id, shared_key, log_type):
+        self.customer_id = customer_id
+        self.shared_key = shared_key
+        self.log_type = log_type
+
+
+if __name__ == '__main__':
+    unittest.main()